@@ -1,25 +1,42 @@
 """Support for Västtrafik public transport."""
-from datetime import timedelta
+import asyncio
+from datetime import datetime, timedelta
+from functools import partial
+import hashlib
 import logging
+import threading
+from time import monotonic
 
+from requests.exceptions import RequestException
 import vasttrafik
 import voluptuous as vol
 
 from homeassistant.components.sensor import PLATFORM_SCHEMA
 from homeassistant.const import ATTR_ATTRIBUTION, CONF_NAME
+from homeassistant.core import callback
 import homeassistant.helpers.config_validation as cv
 from homeassistant.helpers.entity import Entity
-from homeassistant.util import Throttle
+from homeassistant.helpers.storage import Store
+from homeassistant.helpers.update_coordinator import DataUpdateCoordinator, UpdateFailed
 from homeassistant.util.dt import now
 
 _LOGGER = logging.getLogger(__name__)
 
+DOMAIN = "vasttrafik"
+
 ATTR_ACCESSIBILITY = "accessibility"
 ATTR_DIRECTION = "direction"
 ATTR_LINE = "line"
 ATTR_TRACK = "track"
 ATTRIBUTION = "Data provided by Västtrafik"
 
+DEPARTURE_ATTRIBUTES = (
+    (ATTR_ACCESSIBILITY, "accessibility"),
+    (ATTR_DIRECTION, "direction"),
+    (ATTR_LINE, "sname"),
+    (ATTR_TRACK, "track"),
+)
+
 CONF_DELAY = "delay"
 CONF_DEPARTURES = "departures"
 CONF_FROM = "from"
@@ -33,6 +50,13 @@ DEFAULT_DELAY = 0
 ICON = "mdi:train"
 
 MIN_TIME_BETWEEN_UPDATES = timedelta(seconds=120)
+MAX_TIME_BETWEEN_UPDATES = timedelta(minutes=30)
+TOKEN_REFRESH_COOLDOWN = 5 * 60
+
+STORAGE_KEY = f"{DOMAIN}.{{}}"
+STORAGE_VERSION = 1
+
+LINES_SCHEMA = vol.All(cv.ensure_list, [cv.string])
 
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
     {
@@ -43,9 +67,7 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
                 vol.Required(CONF_FROM): cv.string,
                 vol.Optional(CONF_DELAY, default=DEFAULT_DELAY): cv.positive_int,
                 vol.Optional(CONF_HEADING): cv.string,
-                vol.Optional(CONF_LINES, default=[]): vol.All(
-                    cv.ensure_list, [cv.string]
-                ),
+                vol.Optional(CONF_LINES, default=[]): LINES_SCHEMA,
                 vol.Optional(CONF_NAME): cv.string,
             }
         ],
@@ -53,16 +75,26 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
 )
 
 
-def setup_platform(hass, config, add_entities, discovery_info=None):
+async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
     """Set up the departure sensor."""
 
-    planner = vasttrafik.JournyPlanner(config.get(CONF_KEY), config.get(CONF_SECRET))
+    # One file per API key, so platform entries don't overwrite each other
+    key_id = hashlib.sha256(config[CONF_KEY].encode()).hexdigest()[:16]
+    store = Store(hass, STORAGE_VERSION, STORAGE_KEY.format(key_id))
+    planner = await hass.async_add_executor_job(
+        VasttrafikPlanner,
+        config.get(CONF_KEY),
+        config.get(CONF_SECRET),
+        await store.async_load(),
+        partial(hass.add_job, store.async_save),
+    )
+    coordinator = VasttrafikDataCoordinator(hass, planner)
     sensors = []
 
     for departure in config.get(CONF_DEPARTURES):
         sensors.append(
             VasttrafikDepartureSensor(
-                planner,
+                coordinator,
                 departure.get(CONF_NAME),
                 departure.get(CONF_FROM),
                 departure.get(CONF_HEADING),
@@ -70,20 +102,218 @@ def setup_platform(hass, config, add_entities, discovery_info=None):
                 departure.get(CONF_DELAY),
             )
         )
-    add_entities(sensors, True)
+    async_add_entities(sensors)
+
+
+class VasttrafikPlanner(vasttrafik.JournyPlanner):
+    """Journey planner that persists its token and limits token renewals."""
+
+    def __init__(self, key, secret, stored_token, save_token):
+        """Initialize the journey planner, reusing a stored token if valid."""
+        self._stored_token = stored_token
+        self._save_token = save_token
+        self._token_lock = threading.Lock()
+        self._token_requested = None
+        super().__init__(key, secret)
+
+    def update_token(self):
+        """Get a token, using the stored one on the first call if still valid.
+
+        During an outage every failed refresh and stop lookup asks for a new
+        token, so one is requested at most once per cooldown period, which
+        spans several refreshes.
+        """
+        with self._token_lock:
+            stored, self._stored_token = self._stored_token, None
+            if stored:
+                expires = datetime.fromtimestamp(stored["expires"])
+                if expires > datetime.now():
+                    self._token = stored["token"]
+                    self._token_expire_date = expires
+                    return
+
+            if (
+                self._token_requested is not None
+                and monotonic() - self._token_requested < TOKEN_REFRESH_COOLDOWN
+            ):
+                _LOGGER.debug("Token was renewed recently, keeping it")
+                return
+
+            self._token_requested = monotonic()
+            try:
+                super().update_token()
+            except (KeyError, ValueError) as err:
+                # The token endpoint returned an error instead of a token
+                raise vasttrafik.Error(f"Unable to get a token: {err}") from err
+            self._save_token(
+                {"token": self._token, "expires": self._token_expire_date.timestamp()}
+            )
+
+
+class VasttrafikDataCoordinator(DataUpdateCoordinator):
+    """Fetch the departure boards for all sensors in one update cycle."""
+
+    def __init__(self, hass, planner):
+        """Initialize the data coordinator."""
+        super().__init__(
+            hass, _LOGGER, name=DOMAIN, update_interval=MIN_TIME_BETWEEN_UPDATES
+        )
+        self.planner = planner
+        self._departures = set()
+        self._fetching = set()
+        self._locations = {}
+        self._empty_refreshes = 0
+
+    async def async_get_location(self, name):
+        """Look up a stop by name, reusing earlier lookups of the same name.
+
+        Return None if there is no such stop.
+        """
+        if name not in self._locations:
+            # Store the pending lookup, so concurrent callers share it
+            self._locations[name] = self.hass.async_add_executor_job(
+                self._get_location, name
+            )
+        lookup = self._locations[name]
+        try:
+            return await lookup
+        except Exception:
+            # Only keep successful lookups, so the next call retries
+            if self._locations.get(name) is lookup:
+                del self._locations[name]
+            raise
+
+    def _get_location(self, name):
+        """Look up a stop by name."""
+        try:
+            locations = self.planner.location_name(name)
+        except vasttrafik.Error:
+            # The stored token may have been revoked
+            _LOGGER.debug("Unable to look up stop, updating token")
+            self.planner.update_token()
+            locations = self.planner.location_name(name)
+        # A single matching stop is returned as a dict
+        if not isinstance(locations, list):
+            locations = [locations] if locations else []
+        if not locations:
+            _LOGGER.error("Unable to find a stop named %s", name)
+            return None
+        return locations[0]
+
+    def register(self, station_id, direction, delay):
+        """Register a departure board to fetch and return its key."""
+        key = (station_id, direction, delay)
+        self._departures.add(key)
+        return key
+
+    async def async_fetch_new_departureboard(self, key):
+        """Fetch a newly registered board instead of waiting for the refresh."""
+        if key in (self.data or {}) or key in self._fetching:
+            return
+
+        self._fetching.add(key)
+        try:
+            board = await self.hass.async_add_executor_job(
+                self._get_departureboard, key, now()
+            )
+        except (vasttrafik.Error, RequestException) as err:
+            _LOGGER.debug("Unable to read departure board %s: %s", key, err)
+            return
+        finally:
+            self._fetching.discard(key)
+
+        self.data = {**(self.data or {}), key: board}
+        for update_callback in self._listeners:
+            update_callback()
+
+    def _get_departureboard(self, key, start):
+        """Fetch a departure board as a list of departures."""
+        station_id, direction, delay = key
+        board = self.planner.departureboard(
+            station_id, direction=direction, date=start + delay if delay else start
+        )
+        # A board with a single departure is returned as a dict
+        if not isinstance(board, list):
+            board = [board] if board else []
+        return board
+
+    async def _async_update_data(self):
+        """Fetch all registered departure boards concurrently."""
+        keys = list(self._departures)
+        # Take every board of this refresh at the same moment
+        start = now()
+        results = await asyncio.gather(
+            *[
+                self.hass.async_add_executor_job(self._get_departureboard, key, start)
+                for key in keys
+            ],
+            return_exceptions=True,
+        )
+
+        boards = {}
+        errors = []
+        for key, result in zip(keys, results):
+            if isinstance(result, (vasttrafik.Error, RequestException)):
+                _LOGGER.debug("Unable to read departure board %s: %s", key, result)
+                errors.append(result)
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                boards[key] = result
+
+        if boards or errors:
+            self._adjust_update_interval(boards, bool(errors))
+
+        if errors and not boards:
+            # A single failing board points to a bad stop, not the token
+            _LOGGER.debug("Unable to read any departure board, updating token")
+            try:
+                await self.hass.async_add_executor_job(self.planner.update_token)
+            except (vasttrafik.Error, RequestException) as err:
+                _LOGGER.debug("Unable to update token: %s", err)
+            raise UpdateFailed(f"Unable to read departure boards: {errors[0]}")
+
+        # Keep the boards of sensors that registered while this refresh ran
+        for key in self._departures.difference(keys):
+            if key in (self.data or {}):
+                boards[key] = self.data[key]
+
+        # A board that failed is left out, so its sensors become unavailable
+        return boards
+
+    def _adjust_update_interval(self, data, failed):
+        """Back off while no station has any departures, e.g. at night.
+
+        A refresh where a board failed resets the interval, so that board is
+        retried at the normal rate.
+        """
+        if failed or any(data.values()):
+            self._empty_refreshes = 0
+            self.update_interval = MIN_TIME_BETWEEN_UPDATES
+            return
+
+        self._empty_refreshes += 1
+        if self._empty_refreshes > 1:
+            self.update_interval = min(
+                self.update_interval * 2, MAX_TIME_BETWEEN_UPDATES
+            )
 
 
 class VasttrafikDepartureSensor(Entity):
     """Implementation of a Vasttrafik Departure Sensor."""
 
-    def __init__(self, planner, name, departure, heading, lines, delay):
+    def __init__(self, coordinator, name, departure, heading, lines, delay):
         """Initialize the sensor."""
-        self._planner = planner
+        self._coordinator = coordinator
         self._name = name or departure
-        self._departure = planner.location_name(departure)[0]
-        self._heading = planner.location_name(heading)[0] if heading else None
-        self._lines = lines if lines else None
+        self._departure_name = departure
+        self._heading_name = heading
+        self._departure = None
+        self._heading = None
+        self._lines = frozenset(lines) if lines else None
         self._delay = timedelta(minutes=delay)
+        self._key = None
+        self._register_task = None
         self._departureboard = None
         self._state = None
         self._attributes = None
@@ -108,20 +338,88 @@ class VasttrafikDepartureSensor(Entity):
         """Return the next departure time."""
         return self._state
 
-    @Throttle(MIN_TIME_BETWEEN_UPDATES)
-    def update(self):
-        """Get the departure board."""
+    @property
+    def should_poll(self):
+        """No need to poll. Coordinator notifies entity of updates."""
+        return False
+
+    @property
+    def available(self):
+        """Return if entity is available."""
+        return self._coordinator.last_update_success and self._key in (
+            self._coordinator.data or {}
+        )
+
+    async def async_added_to_hass(self):
+        """When entity is added to hass."""
+        self.async_on_remove(
+            self._coordinator.async_add_listener(self._handle_coordinator_update)
+        )
+        self._register_task = self.hass.async_create_task(self._async_register())
+        await self._register_task
+
+    async def async_update(self):
+        """Request a refresh of the departure boards."""
+        await self._coordinator.async_request_refresh()
+
+    async def _async_register(self):
+        """Look up the stops and register the departure board."""
         try:
-            self._departureboard = self._planner.departureboard(
-                self._departure["id"],
-                direction=self._heading["id"] if self._heading else None,
-                date=now() + self._delay,
+            departure = await self._coordinator.async_get_location(self._departure_name)
+            heading = (
+                await self._coordinator.async_get_location(self._heading_name)
+                if self._heading_name
+                else None
             )
-        except vasttrafik.Error:
-            _LOGGER.debug("Unable to read departure board, updating token")
-            self._planner.update_token()
+        except (vasttrafik.Error, RequestException) as err:
+            _LOGGER.error("Unable to look up the stops of %s: %s", self._name, err)
+            return
+        if departure is None or (self._heading_name and heading is None):
+            return
+
+        self._departure = departure
+        self._heading = heading
+        self._key = self._coordinator.register(
+            self._departure["id"],
+            self._heading["id"] if self._heading else None,
+            self._delay,
+        )
+        await self._coordinator.async_fetch_new_departureboard(self._key)
+        self._update_departure()
+
+    async def _async_retry_register(self):
+        """Retry the stop lookup that failed when the sensor was added."""
+        await self._async_register()
+        self.async_write_ha_state()
+
+    @callback
+    def _handle_coordinator_update(self):
+        """Handle updated departure boards from the coordinator."""
+        if self._key is None:
+            # Only one registration at a time, e.g. while the sensor is added
+            if self._register_task.done():
+                self._register_task = self.hass.async_create_task(
+                    self._async_retry_register()
+                )
+            return
 
-        if not self._departureboard:
+        self._update_departure()
+        self.async_write_ha_state()
+
+    def _match(self, departure):
+        """Return if the departure is running and on one of the lines."""
+        return "cancelled" not in departure and (
+            not self._lines or departure.get("sname") in self._lines
+        )
+
+    def _update_departure(self):
+        """Get the next departure from the departure board."""
+        self._departureboard = (self._coordinator.data or {}).get(self._key)
+        departure = next(
+            (d for d in self._departureboard or () if self._match(d)), None
+        )
+
+        if departure is None:
             _LOGGER.debug(
                 "No departures from %s heading %s",
                 self._departure["name"],
@@ -129,22 +427,13 @@ class VasttrafikDepartureSensor(Entity):
             )
             self._state = None
             self._attributes = {}
-        else:
-            for departure in self._departureboard:
-                line = departure.get("sname")
-                if not self._lines or line in self._lines:
-                    if "rtTime" in self._departureboard[0]:
-                        self._state = self._departureboard[0]["rtTime"]
-                    else:
-                        self._state = self._departureboard[0]["time"]
-
-                    params = {
-                        ATTR_ACCESSIBILITY: departure.get("accessibility"),
-                        ATTR_ATTRIBUTION: ATTRIBUTION,
-                        ATTR_DIRECTION: departure.get("direction"),
-                        ATTR_LINE: departure.get("sname"),
-                        ATTR_TRACK: departure.get("track"),
-                    }
-
-                    self._attributes = {k: v for k, v in params.items() if v}
-                    break
+            return
+
+        self._state = departure.get("rtTime", departure["time"])
+
+        attributes = {ATTR_ATTRIBUTION: ATTRIBUTION}
+        for attr, field in DEPARTURE_ATTRIBUTES:
+            value = departure.get(field)
+            if value:
+                attributes[attr] = value
+        self._attributes = attributes
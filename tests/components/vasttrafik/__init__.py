@@ -0,0 +1 @@
+"""Tests for the Västtrafik integration."""
@@ -0,0 +1,246 @@
+"""The tests for the Västtrafik sensor platform."""
+import asyncio
+from datetime import datetime, timedelta
+from time import monotonic
+
+import pytest
+import vasttrafik
+
+from homeassistant.components.vasttrafik import sensor as vasttrafik_sensor
+
+from tests.async_mock import AsyncMock, Mock, patch
+
+DEPARTURE = {"sname": "6", "time": "10:05", "direction": "Kortedala"}
+
+
+@pytest.fixture
+def planner():
+    """Return a mock journey planner."""
+    return Mock(departureboard=Mock(return_value=[DEPARTURE]))
+
+
+def register(coordinator, station_id):
+    """Register a departure board without heading or delay."""
+    return coordinator.register(station_id, None, timedelta(0))
+
+
+async def test_back_off_while_boards_are_empty(hass, planner):
+    """Test the update interval grows while every board is empty."""
+    coordinator = vasttrafik_sensor.VasttrafikDataCoordinator(hass, planner)
+    register(coordinator, "1")
+    planner.departureboard.return_value = []
+
+    await coordinator.async_refresh()
+    assert coordinator.update_interval == vasttrafik_sensor.MIN_TIME_BETWEEN_UPDATES
+
+    await coordinator.async_refresh()
+    assert coordinator.update_interval == 2 * vasttrafik_sensor.MIN_TIME_BETWEEN_UPDATES
+
+    for _ in range(10):
+        await coordinator.async_refresh()
+    assert coordinator.update_interval == vasttrafik_sensor.MAX_TIME_BETWEEN_UPDATES
+
+    planner.departureboard.return_value = [DEPARTURE]
+    await coordinator.async_refresh()
+    assert coordinator.update_interval == vasttrafik_sensor.MIN_TIME_BETWEEN_UPDATES
+
+
+async def test_no_back_off_when_a_board_fails(hass, planner):
+    """Test a failed board resets the update interval."""
+    coordinator = vasttrafik_sensor.VasttrafikDataCoordinator(hass, planner)
+    empty = register(coordinator, "1")
+    failing = register(coordinator, "2")
+
+    def departureboard(station_id, **kwargs):
+        if station_id == "2":
+            raise vasttrafik.Error("Error: 500")
+        return []
+
+    planner.departureboard.return_value = []
+    for _ in range(3):
+        await coordinator.async_refresh()
+    assert coordinator.update_interval > vasttrafik_sensor.MIN_TIME_BETWEEN_UPDATES
+
+    planner.departureboard.side_effect = departureboard
+    await coordinator.async_refresh()
+    assert coordinator.last_update_success
+    assert coordinator.update_interval == vasttrafik_sensor.MIN_TIME_BETWEEN_UPDATES
+    assert empty in coordinator.data
+    assert failing not in coordinator.data
+    planner.update_token.assert_not_called()
+
+
+def fake_update_token(planner):
+    """Set a fresh token like JournyPlanner.update_token does."""
+    planner._token = "new-token"
+    planner._token_expire_date = datetime.now() + timedelta(minutes=59)
+
+
+@pytest.fixture
+def mock_update_token():
+    """Mock the token request of the journey planner."""
+    with patch.object(
+        vasttrafik.JournyPlanner,
+        "update_token",
+        autospec=True,
+        side_effect=fake_update_token,
+    ) as update_token:
+        yield update_token
+
+
+def test_planner_reuses_valid_stored_token(mock_update_token):
+    """Test a stored token that has not expired is used without a request."""
+    save_token = Mock()
+    expires = datetime.now() + timedelta(minutes=30)
+    planner = vasttrafik_sensor.VasttrafikPlanner(
+        "key", "secret", {"token": "stored", "expires": expires.timestamp()}, save_token
+    )
+
+    mock_update_token.assert_not_called()
+    save_token.assert_not_called()
+    assert planner._token == "stored"
+    assert planner._token_expire_date == expires
+
+
+def test_planner_requests_token_when_stored_token_expired(mock_update_token):
+    """Test an expired stored token is replaced and the new one saved."""
+    save_token = Mock()
+    expires = datetime.now() - timedelta(minutes=1)
+    planner = vasttrafik_sensor.VasttrafikPlanner(
+        "key", "secret", {"token": "stored", "expires": expires.timestamp()}, save_token
+    )
+
+    assert mock_update_token.call_count == 1
+    assert planner._token == "new-token"
+    save_token.assert_called_once_with(
+        {"token": "new-token", "expires": planner._token_expire_date.timestamp()}
+    )
+
+
+def test_planner_requests_token_without_stored_token(mock_update_token):
+    """Test a token is requested and saved when nothing was stored."""
+    save_token = Mock()
+    planner = vasttrafik_sensor.VasttrafikPlanner("key", "secret", None, save_token)
+
+    assert mock_update_token.call_count == 1
+    assert planner._token == "new-token"
+    assert save_token.call_count == 1
+    assert "key" not in save_token.call_args[0][0]
+
+
+def test_planner_replaces_revoked_stored_token(mock_update_token):
+    """Test the next renewal after using a stored token requests a new one."""
+    save_token = Mock()
+    expires = datetime.now() + timedelta(minutes=30)
+    planner = vasttrafik_sensor.VasttrafikPlanner(
+        "key", "secret", {"token": "stored", "expires": expires.timestamp()}, save_token
+    )
+
+    planner.update_token()
+
+    assert mock_update_token.call_count == 1
+    assert planner._token == "new-token"
+    assert save_token.call_count == 1
+
+
+def test_planner_limits_token_renewals(mock_update_token):
+    """Test a new token is requested at most once per cooldown."""
+    planner = vasttrafik_sensor.VasttrafikPlanner("key", "secret", None, Mock())
+    assert mock_update_token.call_count == 1
+
+    with patch(
+        "homeassistant.components.vasttrafik.sensor.monotonic",
+        return_value=monotonic() + vasttrafik_sensor.TOKEN_REFRESH_COOLDOWN - 10,
+    ):
+        planner.update_token()
+    assert mock_update_token.call_count == 1
+
+    with patch(
+        "homeassistant.components.vasttrafik.sensor.monotonic",
+        return_value=monotonic() + vasttrafik_sensor.TOKEN_REFRESH_COOLDOWN + 10,
+    ):
+        planner.update_token()
+    assert mock_update_token.call_count == 2
+
+
+def test_planner_token_error(mock_update_token):
+    """Test an error response from the token endpoint raises a vasttrafik.Error."""
+    planner = vasttrafik_sensor.VasttrafikPlanner("key", "secret", None, Mock())
+    mock_update_token.side_effect = KeyError("access_token")
+
+    with patch(
+        "homeassistant.components.vasttrafik.sensor.monotonic",
+        return_value=monotonic() + vasttrafik_sensor.TOKEN_REFRESH_COOLDOWN + 10,
+    ), pytest.raises(vasttrafik.Error):
+        planner.update_token()
+
+
+async def test_token_renewed_only_when_every_board_fails(hass, planner, caplog):
+    """Test the token is renewed, and the refresh fails, if no board is read."""
+    coordinator = vasttrafik_sensor.VasttrafikDataCoordinator(hass, planner)
+    register(coordinator, "1")
+    register(coordinator, "2")
+    planner.departureboard.side_effect = vasttrafik.Error("Error: 401")
+    planner.update_token.side_effect = vasttrafik.Error("Unable to get a token")
+
+    await coordinator.async_refresh()
+
+    assert not coordinator.last_update_success
+    assert planner.update_token.call_count == 1
+    assert "Unexpected error" not in caplog.text
+
+
+async def test_unexpected_board_error_is_raised(hass, planner, caplog):
+    """Test an error that is not an API error is not taken as a failed board."""
+    coordinator = vasttrafik_sensor.VasttrafikDataCoordinator(hass, planner)
+    register(coordinator, "1")
+    planner.departureboard.side_effect = TypeError("bug")
+
+    await coordinator.async_refresh()
+
+    assert not coordinator.last_update_success
+    assert "Unexpected error fetching vasttrafik data" in caplog.text
+    planner.update_token.assert_not_called()
+
+
+async def test_failed_location_lookup_is_retried(hass, planner):
+    """Test a stop lookup that raised is not cached."""
+    coordinator = vasttrafik_sensor.VasttrafikDataCoordinator(hass, planner)
+    stop = {"id": "1", "name": "Centralstationen"}
+    planner.location_name.side_effect = [ValueError("Bad response"), [stop]]
+
+    with pytest.raises(ValueError):
+        await coordinator.async_get_location("Centralstationen")
+
+    assert await coordinator.async_get_location("Centralstationen") == stop
+    assert await coordinator.async_get_location("Centralstationen") == stop
+    assert planner.location_name.call_count == 2
+
+
+async def test_one_registration_at_a_time(hass, planner):
+    """Test coordinator updates during a stop lookup start no new lookup."""
+    coordinator = vasttrafik_sensor.VasttrafikDataCoordinator(hass, planner)
+    lookup_done = asyncio.Event()
+
+    async def slow_lookup(name):
+        await lookup_done.wait()
+        return {"id": "1", "name": name}
+
+    coordinator.async_get_location = AsyncMock(side_effect=slow_lookup)
+    sensor = vasttrafik_sensor.VasttrafikDepartureSensor(
+        coordinator, None, "Centralstationen", None, None, 0
+    )
+    sensor.hass = hass
+    sensor.entity_id = "sensor.centralstationen"
+
+    added = hass.async_create_task(sensor.async_added_to_hass())
+    await asyncio.sleep(0)
+    for _ in range(3):
+        sensor._handle_coordinator_update()
+    lookup_done.set()
+    await added
+    await hass.async_block_till_done()
+
+    assert coordinator.async_get_location.call_count == 1
+    assert planner.departureboard.call_count == 1
+    assert sensor.state == "10:05"